@@ -1,27 +1,70 @@
 import os
-import logging
 import pickle
-import yaml
+import logging
+import struct
+import datetime as dt
+import msgpack
 
 
 _CACHE_DIR = '.orgcal_cache'
 
+_EXT_TIMEDELTA = 1
+_EXT_DATE = 2
+
+
+def _encode_ext(obj):
+    # aware datetimes are handled natively by msgpack
+    if isinstance(obj, dt.timedelta):
+        return msgpack.ExtType(_EXT_TIMEDELTA, struct.pack('>d', obj.total_seconds()))
+    if type(obj) is dt.date:
+        return msgpack.ExtType(_EXT_DATE, struct.pack('>I', obj.toordinal()))
+    raise TypeError(f'Cannot serialize {type(obj).__name__} to cache: {obj!r}')
+
+
+def _decode_ext(code: int, data: bytes):
+    if code == _EXT_TIMEDELTA:
+        return dt.timedelta(seconds=struct.unpack('>d', data)[0])
+    if code == _EXT_DATE:
+        return dt.date.fromordinal(struct.unpack('>I', data)[0])
+    return msgpack.ExtType(code, data)
+
 
 def check_cache_dir() -> None:
-    if not os.path.exists(_CACHE_DIR):
-        logging.debug(f'Creating cache directory: {_CACHE_DIR}')
-        os.makedirs(_CACHE_DIR)
+    os.makedirs(_CACHE_DIR, exist_ok=True)
 
 
 def read_cache_file(filename: str) -> dict | None:
     full_filename = os.path.join(_CACHE_DIR, filename)
     try:
         with open(full_filename, 'rb') as cache_file:
-            return pickle.load(cache_file)
+            return msgpack.unpackb(cache_file.read(), timestamp=3, ext_hook=_decode_ext)
     except Exception as e:
         logging.error(e)
 
 
 def write_cache_file(filename: str, data: dict) -> None:
-    with open(os.path.join(_CACHE_DIR, filename), 'wb') as cache_file:
-        pickle.dump(data, cache_file)
+    full_filename = os.path.join(_CACHE_DIR, filename)
+    temp_filename = f'{full_filename}.tmp'
+
+    # swap the file in whole, an interrupted write keeps the previous cache
+    with open(temp_filename, 'wb') as cache_file:
+        msgpack.pack(data, cache_file, datetime=True, default=_encode_ext)
+    os.replace(temp_filename, full_filename)
+
+
+def cache_file_exists(filename: str) -> bool:
+    return os.path.isfile(os.path.join(_CACHE_DIR, filename))
+
+
+def read_legacy_cache_file(filename: str) -> dict | None:
+    # pickle caches written before msgpack, only read to migrate them once
+    full_filename = os.path.join(_CACHE_DIR, filename)
+    try:
+        with open(full_filename, 'rb') as cache_file:
+            return pickle.load(cache_file)
+    except Exception as e:
+        logging.error(e)
+
+
+def remove_cache_file(filename: str) -> None:
+    os.remove(os.path.join(_CACHE_DIR, filename))
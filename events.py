@@ -1,14 +1,21 @@
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, astuple
+import copy
 import orgparse
 import datetime as dt
 import caldav
 import caldav.lib.error
 import caldav.objects
-import pytz
+from caldav.elements import dav
 import logging
 import re
 
-from utils import get_datetime_from_org, clean_up_heading
+from utils import (
+    get_datetime_from_org,
+    clean_up_heading,
+    _TIMEZONE,
+    _DEFAULT_TIMEZONE,
+)
+
 
 _REPEAT_TO_FREQ = {
     "d": "DAILY",
@@ -16,9 +23,13 @@ _REPEAT_TO_FREQ = {
     "m": "MONTHLY",
     "y": "YEARLY",
 }
+_RANGE_RE = {
+    prop: re.compile(f"{prop}: (<[^>]*>--<[^>]*>)")
+    for prop in ("SCHEDULED", "DEADLINE")
+}
 
 
-@dataclass
+@dataclass(slots=True)
 class Event:
     uid: str = ''
     title: str = ''
@@ -35,9 +46,8 @@ class Event:
 
     @staticmethod
     def from_ical(remote_event: caldav.CalendarObjectResource) -> 'Event':
-        if hasattr(remote_event, 'icalendar_component'):
-            ical = getattr(remote_event, 'icalendar_component')
-        else:
+        ical = getattr(remote_event, 'icalendar_component', None)
+        if ical is None:
             raise RuntimeError(
                 'remote_event does not have icalendar_component attribute'
             )
@@ -48,21 +58,22 @@ class Event:
         self.uid = ical['UID']
         self.title = ical['SUMMARY']
         self.description = ical.get('DESCRIPTION', '')
-        self.tags = []
-        tags = ical.get('CATEGORIES', None)
-        if tags and hasattr(tags, "cats"):
-            for cat in tags.cats:
-                self.tags.append(str(cat))
-        self.tags = sorted(filter(lambda e: len(e) > 0, self.tags))
+        categories = ical.get('CATEGORIES', [])
+        if not isinstance(categories, list):
+            categories = [categories]
+        self.tags = sorted(
+            tag
+            for category in categories
+            for cat in getattr(category, 'cats', ())
+            if (tag := str(cat))
+        )
 
         recurrence = ical.get('RRULE', None)
         if recurrence:
-            self.recurrence_freq = recurrence["FREQ"]
-            self.recurrence_interval = recurrence["INTERVAL"]
-            try:
-                self.recurrence_count = recurrence["COUNT"]
-            except KeyError:
-                self.recurrence_count = 0
+            # rule parts are parsed into lists of values
+            self.recurrence_freq = recurrence["FREQ"][0]
+            self.recurrence_interval = recurrence.get("INTERVAL", [1])[0]
+            self.recurrence_count = recurrence.get("COUNT", [0])[0]
 
         scheduled = ical.get('DTSTART', None)
         self.scheduled = scheduled.dt if scheduled else None
@@ -80,6 +91,23 @@ class Event:
 
         return self
 
+    @staticmethod
+    def from_cache(values: list) -> 'Event':
+        self = Event(*values)
+
+        # the cache restores aware datetimes in UTC
+        if isinstance(self.scheduled, dt.datetime):
+            self.scheduled = self.scheduled.astimezone(_TIMEZONE)
+        if isinstance(self.created_at, dt.datetime):
+            self.created_at = self.created_at.astimezone(_TIMEZONE)
+        if isinstance(self.last_modified_at, dt.datetime):
+            self.last_modified_at = self.last_modified_at.astimezone(_TIMEZONE)
+
+        return self
+
+    def to_cache(self) -> tuple:
+        return astuple(self)
+
     @staticmethod
     def from_org(node) -> 'Event':
         self = Event()
@@ -91,14 +119,14 @@ class Event:
 
         # properties
         self.created_at = get_datetime_from_org(
-            node.get_property('CREATED_AT', ''), 'CREATED_AT'
+            node.get_property('CREATED_AT', '')
         )
         self.last_modified_at = get_datetime_from_org(
-            node.get_property('LAST_MODIFIED_AT', ''), 'LAST_MODIFIED_AT'
+            node.get_property('LAST_MODIFIED_AT', '')
         )
 
         # get tags
-        self.tags = list(filter(lambda e: len(e) > 0, node.tags))
+        self.tags = [tag for tag in node.tags if tag]
 
         # mark as done
         if node.todo:
@@ -115,7 +143,7 @@ class Event:
 
             # base time
             self.scheduled = (
-                pytz.timezone('Europe/Berlin').localize(node.scheduled.start)
+                _TIMEZONE.localize(node.scheduled.start)
                 if isinstance(node.scheduled.start, dt.datetime)
                 else node.scheduled.start
             )
@@ -139,14 +167,15 @@ class Event:
         # check for deadline
         if node.deadline and node.scheduled != node.deadline:
 
-            # clone
-            self = replace(self)
+            # clone, the tags list must not be shared with the scheduled event
+            self = copy.copy(self)
+            self.tags = list(self.tags)
 
             # override properties
             self.title = f"{self.title}!"
             self.tags.append("deadline")
             self.scheduled = (
-                pytz.timezone('Europe/Berlin').localize(node.deadline.start)
+                _TIMEZONE.localize(node.deadline.start)
                 if isinstance(node.deadline.start, dt.datetime)
                 else node.deadline.start
             )
@@ -155,7 +184,7 @@ class Event:
             # repeat
             if hasattr(node.deadline, "_repeater"):
                 self.recurrence_freq, self.recurrence_interval, self.recurrence_count = \
-                    self._get_recurrence(node.scheduled._repeater)
+                    self._get_recurrence(node.deadline._repeater)
             else:
                 self.recurrence_freq = ""
                 self.recurrence_interval = 0
@@ -182,7 +211,7 @@ class Event:
             # try scheduled range
             # workaround because orgparse scheduled end is set to None
             node_str = str(node)
-            scheduled_match = re.search(f"{prop}: (<.*>--<.*>)", node_str)
+            scheduled_match = _RANGE_RE[prop].search(node_str)
             if scheduled_match:
                 scheduled_str = scheduled_match.group(1)
                 if scheduled_str:
@@ -206,26 +235,13 @@ class Event:
         recurrence_freq = ""
         recurrence_interval = 0
         recurrence_count = 0
+
+        # orgparse parses repeaters into (prefix, interval, unit) tuples
         if repeater and len(repeater) == 3:
-            plus = False
-            interval = False
-            for char in repeater:
-                if char == " ":
-                    plus = False
-                    interval = False
-                elif interval:
-                    try:
-                        recurrence_freq = _REPEAT_TO_FREQ[char]
-                    except KeyError:
-                        recurrence_freq = ""
-                        recurrence_interval = 0
-                elif plus:
-                    if isinstance(char, int):
-                        recurrence_interval = char
-                        interval = True
-                else:
-                    if char == "+":
-                        plus = True
+            _, interval, unit = repeater
+            if unit in _REPEAT_TO_FREQ:
+                recurrence_freq = _REPEAT_TO_FREQ[unit]
+                recurrence_interval = interval
 
         # done
         return recurrence_freq, recurrence_interval, recurrence_count
@@ -240,6 +256,60 @@ class Event:
         except caldav.lib.error.NotFoundError:
             return None
 
+    @staticmethod
+    def find_remote_events(
+        calendar: caldav.Calendar
+    ) -> dict[str, caldav.CalendarObjectResource]:
+        return {
+            str(remote_event.icalendar_component['UID']): remote_event
+            for remote_event in calendar.events()
+        }
+
+    @staticmethod
+    def sync_remote_events(
+        calendar: caldav.Calendar,
+        sync_token: str | None,
+        remote_data: dict[str, str],
+    ) -> tuple[dict[str, caldav.CalendarObjectResource], str | None]:
+        # only ask for changes since the last sync, ref RFC 6578
+        changes = None
+        if sync_token:
+            try:
+                changes = calendar.objects_by_sync_token(sync_token=sync_token)
+            except caldav.lib.error.DAVError:
+                logging.debug('Sync token was rejected, fetching all events.')
+
+        if changes is None:
+            remote_data.clear()
+            try:
+                changes = calendar.objects_by_sync_token()
+            except caldav.lib.error.DAVError:
+                logging.debug('WebDAV sync is not supported, listing all events.')
+                return Event.find_remote_events(calendar), None
+
+        # drop deleted objects, fetch changed ones with a single multiget
+        changed_urls = []
+        for remote_object in changes:
+            if remote_object.props.get(dav.GetEtag.tag):
+                changed_urls.append(remote_object.url)
+            else:
+                remote_data.pop(str(remote_object.url), None)
+        if changed_urls:
+            for remote_object in calendar.calendar_multiget(changed_urls):
+                remote_data[str(remote_object.url)] = remote_object.data
+
+        # index the local copy of the calendar by UID
+        remote_events = {}
+        for url, data in remote_data.items():
+            remote_event = caldav.Event(
+                calendar.client, url=url, data=data, parent=calendar
+            )
+            ical = remote_event.icalendar_component
+            if ical.name == 'VEVENT':
+                remote_events[str(ical['UID'])] = remote_event
+
+        return remote_events, changes.sync_token
+
     @staticmethod
     def find_event(calendar: caldav.Calendar, uid: str) -> 'Event | None':
         remote_event = Event.find_remote_event(calendar, uid)
@@ -281,9 +351,8 @@ class Event:
 
     def update_remote_event(self, remote_event: caldav.CalendarObjectResource) -> None:
         try:
-            if hasattr(remote_event, 'icalendar_component'):
-                ical = getattr(remote_event, 'icalendar_component')
-            else:
+            ical = getattr(remote_event, 'icalendar_component', None)
+            if ical is None:
                 raise RuntimeError(
                     '\'remote_event\' does not have icalendar_component attribute.'
                 )
@@ -294,36 +363,39 @@ class Event:
             if self.tags:
                 ical['CATEGORIES'] = self.tags
             else:
-                ical['CATEGORIES'] = []
+                ical.pop('CATEGORIES', None)
 
             # start time
-            ical['DTSTART'].dt = self.scheduled
+            dtstart = ical['DTSTART']
+            dtstart.dt = self.scheduled
+            dtstart_params = dtstart.params
             if isinstance(self.scheduled, dt.datetime):
-                ical['DTSTART'].params['TZID'] = 'Europe/Berlin'
-                if 'VALUE' in ical['DTSTART'].params:
-                    del ical['DTSTART'].params['VALUE']
+                dtstart_params['TZID'] = _DEFAULT_TIMEZONE
+                dtstart_params.pop('VALUE', None)
             elif isinstance(self.scheduled, dt.date):
-                ical['DTSTART'].params['VALUE'] = 'DATE'
-                if 'TZID' in ical['DTSTART'].params:
-                    del ical['DTSTART'].params['TZID']
+                dtstart_params['VALUE'] = 'DATE'
+                dtstart_params.pop('TZID', None)
 
-            # end time
-            ical['DTEND'].dt = (
+            # end time, events saved without one have no DTEND yet
+            end = (
                 self.scheduled + self.duration
                 if self.scheduled and self.duration
                 else self.scheduled
             )
-            if isinstance(self.scheduled, dt.datetime) and self.duration:
-                ical['DTEND'].params['TZID'] = 'Europe/Berlin'
-                if 'VALUE' in ical['DTEND'].params:
-                    del ical['DTEND'].params['VALUE']
+            if 'DTEND' not in ical:
+                ical.add('DTEND', end)
+            dtend = ical['DTEND']
+            dtend.dt = end
+            dtend_params = dtend.params
+            if isinstance(self.scheduled, dt.datetime):
+                dtend_params['TZID'] = _DEFAULT_TIMEZONE
+                dtend_params.pop('VALUE', None)
             elif isinstance(self.scheduled, dt.date):
-                ical['DTEND'].params['VALUE'] = 'DATE'
-                if 'TZID' in ical['DTEND'].params:
-                    del ical['DTEND'].params['TZID']
+                dtend_params['VALUE'] = 'DATE'
+                dtend_params.pop('TZID', None)
 
             # filter same time
-            if ical['DTSTART'] == ical['DTEND']:
+            if dtstart == dtend:
                 del ical['DTEND']
 
             remote_event.save()
@@ -333,15 +405,16 @@ class Event:
 
     @staticmethod
     def compare_events(event1: 'Event', event2: 'Event') -> bool:
+        # cheap fixed-size fields first, the free-form description last
         return (
-            event1.title == event2.title
-            and event1.scheduled == event2.scheduled
-            and event1.duration == event2.duration
-            and event1.description == event2.description
+            event1.scheduled == event2.scheduled
+            and (event1.duration or None) == (event2.duration or None)
             and event1.recurrence_freq == event2.recurrence_freq
             and event1.recurrence_interval == event2.recurrence_interval
             and event1.recurrence_count == event2.recurrence_count
+            and event1.title == event2.title
             and event1.tags == event2.tags
+            and event1.description == event2.description
         )
 
     def compare_with_ical(self, remote_event: caldav.CalendarObjectResource) -> bool:
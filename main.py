@@ -1,143 +1,304 @@
+import os
 import uuid
 import hashlib
 import logging
 import caldav
+import multiprocessing
 import datetime as dt
 
+from itertools import chain
+from contextlib import ExitStack
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
 from utils import (
     setup_logging,
     read_config_file,
     parse_args,
-    load_all_headings_from_mixed_list,
+    get_all_org_files_from_mixed_list,
+    load_all_headings_from_file,
     force_timestamp,
 )
 from events import Event
-from cache import check_cache_dir, read_cache_file, write_cache_file
+from cache import (
+    check_cache_dir,
+    cache_file_exists,
+    read_cache_file,
+    read_legacy_cache_file,
+    write_cache_file,
+    remove_cache_file,
+)
+
+_MAX_WORKERS = 8
+
+# field order of the dict entries in legacy pickle caches
+_LEGACY_CACHE_KEYS = (
+    'title', 'scheduled', 'duration', 'description',
+    'recurrence_freq', 'recurrence_interval', 'recurrence_count', 'tags',
+)
+
+# bump whenever parsing changes, cached file events are reparsed then
+_PARSE_VERSION = 1
+
+
+def sync_event(
+    event: Event,
+    remote_calendar: caldav.Calendar,
+    remote_events: dict[str, caldav.CalendarObjectResource],
+) -> str | None:
+    try:
+        # update event
+        if remote_event := remote_events.get(event.uid):
+            if event.compare_with_ical(remote_event):
+                return '= '
+            event.update_remote_event(remote_event)
+            return '~ '
+
+        # create event
+        event.save_to_calendar(remote_calendar)
+        return '+ '
+
+    except Exception as e:
+
+        # log event and exception
+        logging.error(event)
+        logging.error(e)
+        return None
+
+
+def delete_event(remote_event: caldav.CalendarObjectResource) -> bool:
+    try:
+        remote_event.delete()
+        return True
+
+    except Exception as e:
+
+        # log event and exception
+        logging.error(remote_event)
+        logging.error(e)
+        return False
+
 
+def load_events_from_file(filename: str) -> list[tuple]:
+    return [
+        event.to_cache()
+        for node in load_all_headings_from_file(filename) or []
+        for event in Event.from_org(node)
+    ]
 
-def process_calendar(calendar: dict) -> None:
+
+def load_all_events_from_files(
+    files: list[str], file_cache: dict, parse_executor: ProcessPoolExecutor
+) -> dict:
+    new_file_cache = {}
+    changed_files = []
+
+    # reuse events of files whose modification time and size did not change
+    for filename in files:
+        try:
+            stat = os.stat(filename)
+        except OSError as e:
+            logging.error(e)
+            continue
+        entry = file_cache.get(filename)
+        if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+            new_file_cache[filename] = entry
+        else:
+            changed_files.append((filename, stat.st_mtime_ns, stat.st_size))
+
+    # parse changed files across processes, orgparse is pure Python
+    if changed_files:
+        results = parse_executor.map(
+            load_events_from_file,
+            [filename for filename, _, _ in changed_files],
+        )
+        for (filename, mtime_ns, size), file_events in zip(changed_files, results):
+            new_file_cache[filename] = [mtime_ns, size, file_events]
+
+    # keep the order of the file list
+    return {
+        filename: new_file_cache[filename]
+        for filename in files
+        if filename in new_file_cache
+    }
+
+
+def generate_missing_uids(events: list[Event], calendar_id: str) -> None:
+    # generated IDs all start with the calendar ID, hash it only once
+    calendar_hash = hashlib.sha256(f"{calendar_id}\0".encode("utf-8"))
+
+    for event in events:
+        if event.uid is None:
+            hash_str = \
+                f"{event.title}\0{event.scheduled}\0" \
+                f"{event.recurrence_freq}\0{event.recurrence_interval}\0{event.recurrence_count}"
+            uid_hash = calendar_hash.copy()
+            uid_hash.update(hash_str.encode("utf-8"))
+            # the low 128 bits of the digest, as generated IDs have always been
+            event.uid = str(uuid.UUID(bytes=uid_hash.digest()[16:], version=4))
+
+
+def migrate_legacy_cache(calendar_id: str, cache_filename: str) -> None:
+    legacy_filename = f'{calendar_id}.bin'
+    if cache_file_exists(cache_filename) or not cache_file_exists(legacy_filename):
+        return
+
+    if (legacy_cache := read_legacy_cache_file(legacy_filename)) is None:
+        return
+
+    # keep the old events so that removed ones are still deleted remotely
+    logging.info(f'Migrating legacy cache: {legacy_filename}')
+    write_cache_file(cache_filename, {
+        'cache': {
+            uid: tuple(entry[key] for key in _LEGACY_CACHE_KEYS)
+            for uid, entry in legacy_cache.get('cache', {}).items()
+        },
+    })
+    remove_cache_file(legacy_filename)
+
+
+def process_calendar(
+    calendar: dict,
+    client: caldav.DAVClient,
+    parse_executor: ProcessPoolExecutor,
+) -> None:
     server_url = calendar['url']
     calendar_id = calendar['id']
     calendar_url = server_url + calendar_id
 
     logging.info(f'Processing calendar: {calendar_id}')
 
-    events = sorted(
-        [event for generator in map(
-            Event.from_org,
-            load_all_headings_from_mixed_list(calendar['org_files']),
-        ) for event in generator],
-        key=lambda event: hash(event.scheduled),
-    )
-
-    cache_filename = f'{calendar_id}.bin'
+    cache_filename = f'{calendar_id}.msgpack'
+    migrate_legacy_cache(calendar_id, cache_filename)
     cache_file = read_cache_file(cache_filename)
 
     if not cache_file:
         write_cache_file(cache_filename, {'cache': {}})
-        old_cache = {}
-    else:
-        old_cache = cache_file.get('cache', {})
+        cache_file = {}
+
+    # events parsed by an older version are stale
+    file_cache = {}
+    if cache_file.get('parse_version') == _PARSE_VERSION:
+        file_cache = cache_file.get('files', {})
+
+    file_cache = load_all_events_from_files(
+        get_all_org_files_from_mixed_list(calendar['org_files']),
+        file_cache,
+        parse_executor,
+    )
+    events = sorted(
+        map(Event.from_cache, chain.from_iterable(
+            entry[2] for entry in file_cache.values()
+        )),
+        key=lambda event: force_timestamp(event.scheduled),
+    )
+
+    generate_missing_uids(events, calendar_id)
+
+    old_cache = cache_file.get('cache', {})
+    sync_token = cache_file.get('sync_token')
+    remote_data = cache_file.get('remote', {})
 
-    old_events = list(old_cache.keys())
     new_cache = {}
 
-    # optionally read password from file
-    file_prefix = "file="
-    if calendar['password'].startswith("file="):
+    remote_calendar = client.calendar(url=calendar_url)
+
+    if not remote_calendar:
+        logging.error(f'Calendar not found: {calendar_id}')
+        return
+
+    processed_uids = set()
+    pending_events = []
+    for i, event in enumerate(events):
         try:
-            with open(calendar['password'][len(file_prefix):], "r") as password_file:
-                calendar['password'] = password_file.read().strip()
-        except:
-            pass
-
-    with caldav.DAVClient(
-        url=server_url,
-        username=calendar['username'],
-        password=calendar['password'],
-    ) as client:
-        remote_calendar = client.calendar(url=calendar_url)
-
-        if not remote_calendar:
-            logging.error(f'Calendar not found: {calendar_id}')
-            return
+            # prevent duplicate IDs
+            if event.uid in processed_uids:
+                continue
+            processed_uids.add(event.uid)
+
+            # build new cache
+            new_cache[event.uid] = cache_entry = (
+                event.title,
+                event.scheduled,
+                event.duration,
+                event.description,
+                event.recurrence_freq,
+                event.recurrence_interval,
+                event.recurrence_count,
+                event.tags,
+            )
+
+            # skip when matching, entries are read back as lists
+            old_event = old_cache.pop(event.uid, None)
+            if old_event is not None and tuple(old_event) == cache_entry:
+                continue
 
-        processed_uids = set()
-        for i, event in enumerate(events):
-            try:
-                # generate ID if event has none attached
-                if event.uid is None:
-                    hash_str = \
-                        f"{calendar_id}\0{event.title}\0{event.scheduled}\0" \
-                        f"{event.recurrence_freq}\0{event.recurrence_interval}\0{event.recurrence_count}"
-                    hash_val = int(hashlib.sha256(hash_str.encode("utf-8")).hexdigest(), 16)
-                    event.uid = str(uuid.UUID(int=hash_val & ((1 << 128) - 1), version=4))
-
-                # prevent duplicate IDs
-                if event.uid in processed_uids:
-                    continue
-                processed_uids.add(event.uid)
-
-                # build new cache
-                new_cache[event.uid] = {
-                    'title': event.title,
-                    'scheduled': event.scheduled,
-                    'duration': event.duration,
-                    'description': event.description,
-                    'recurrence_freq': event.recurrence_freq,
-                    'recurrence_interval': event.recurrence_interval,
-                    'recurrence_count': event.recurrence_count,
-                    'tags': event.tags,
-                }
-
-                # search in old events
-                skip = False
-                if event.uid in old_events:
-                    old_events.remove(event.uid)
-
-                    # skip when matching
-                    old_event = old_cache[event.uid]
-                    if old_cache[event.uid] == new_cache[event.uid]:
-                        continue
-
-                # update event
-                if remote_event := Event.find_remote_event(remote_calendar, event.uid):
-                    if event.compare_with_ical(remote_event):
-                        prefix = '= '
-                    else:
-                        event.update_remote_event(remote_event)
-                        prefix = '~ '
-                else:
-                    event.save_to_calendar(remote_calendar)
-                    prefix = '+ '
-
-                # announce status
-                time_str = f'{event.scheduled:%Y-%m-%d %H:%M}'
-                if event.scheduled and event.duration:
-                    time_str += f'--{event.scheduled + event.duration:%H:%M}'
-                status_string = f'[{i + 1:03}/{len(events):03}] [{time_str}] {event.title}'
-                logging.info(prefix + status_string)
-
-            except Exception as e:
-
-                # log event and exception
-                logging.error(event)
-                logging.error(e)
-
-        # delete old elements
-        for uid in old_events:
-            if remote_event := Event.find_remote_event(remote_calendar, uid):
-                logging.info(f'Removing cached event "{old_cache[uid]["title"]}".')
-                remote_event.delete()
-
-        # persist cache
-        write_cache_file(
-            cache_filename,
-            {
-                'cache': new_cache,
-            },
+            pending_events.append((i, event))
+
+        except Exception as e:
+
+            # log event and exception
+            logging.error(event)
+            logging.error(e)
+
+    # fetch remote events once, only when something changed
+    remote_events = {}
+    if pending_events or old_cache:
+        remote_events, sync_token = Event.sync_remote_events(
+            remote_calendar, sync_token, remote_data
         )
 
+    # status prefix width, at least three digits
+    total = len(events)
+    width = max(3, len(str(total)))
+
+    # old events left in the cache but still present on the server
+    stale_events = [
+        (uid, remote_event)
+        for uid in old_cache
+        if (remote_event := remote_events.get(uid))
+    ]
+
+    # push changed and delete old events concurrently, announce them in order
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        prefixes = executor.map(
+            lambda pending: sync_event(pending[1], remote_calendar, remote_events),
+            pending_events,
+        )
+        deleted = executor.map(
+            delete_event, [remote_event for _, remote_event in stale_events]
+        )
+        for (i, event), prefix in zip(pending_events, prefixes):
+            if prefix is None:
+                continue
+
+            # announce status
+            time_str = f'{event.scheduled:%Y-%m-%d %H:%M}'
+            if event.scheduled and event.duration:
+                time_str += f'--{event.scheduled + event.duration:%H:%M}'
+            status_string = f'[{i + 1:0{width}}/{total:0{width}}] [{time_str}] {event.title}'
+            logging.info(prefix + status_string)
+
+        for (uid, _), success in zip(stale_events, deleted):
+            # keep failed deletes cached, the next run retries them
+            if not success:
+                new_cache[uid] = old_cache[uid]
+                continue
+
+            logging.info(f'Removing cached event "{old_cache[uid][0]}".')
+
+    # persist cache
+    write_cache_file(
+        cache_filename,
+        {
+            'cache': new_cache,
+            'sync_token': sync_token,
+            'remote': remote_data,
+            'files': file_cache,
+            'parse_version': _PARSE_VERSION,
+        },
+    )
+
 
 def main(
     config_file: str = 'config.yml',
@@ -148,10 +309,62 @@ def main(
         if not (config := read_config_file(config_file)):
             return
 
-        # process all calendars
         calendars = config.get('calendars', [])
+
+        # optionally read passwords from files
+        file_prefix = "file="
         for calendar in calendars:
-            process_calendar(calendar)
+            if calendar['password'].startswith(file_prefix):
+                try:
+                    with open(calendar['password'][len(file_prefix):], "r") as password_file:
+                        calendar['password'] = password_file.read().strip()
+                except:
+                    pass
+
+        # group calendars sharing a server account
+        accounts = [
+            (calendar['url'], calendar['username'], calendar['password'])
+            for calendar in calendars
+        ]
+
+        with ExitStack() as stack:
+
+            # one parser pool for all calendars, spawned so that workers never
+            # inherit locks held by the calendar threads
+            parse_executor = stack.enter_context(ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+            ))
+
+            # one client per account, its connections are kept alive across calendars
+            clients = {}
+            for account in dict.fromkeys(accounts):
+                url, username, password = account
+                client = stack.enter_context(
+                    caldav.DAVClient(url=url, username=username, password=password)
+                )
+
+                # room for the push workers of every calendar on this account
+                adapter = HTTPAdapter(pool_maxsize=_MAX_WORKERS * accounts.count(account))
+                client.session.mount('http://', adapter)
+                client.session.mount('https://', adapter)
+                clients[account] = client
+
+            # process all calendars concurrently
+            with ThreadPoolExecutor(max_workers=max(1, len(calendars))) as executor:
+                futures = [
+                    executor.submit(process_calendar, calendar, clients[account], parse_executor)
+                    for calendar, account in zip(calendars, accounts)
+                ]
+
+                # report every failed calendar, one failure must not hide another
+                for calendar, future in zip(calendars, futures):
+                    if ex := future.exception():
+                        logging.error(f'Failed to process calendar: {calendar["id"]}')
+                        if debug:
+                            logging.error(ex, exc_info=ex)
+                        else:
+                            logging.error(ex)
 
     except Exception as ex:
         if debug:
@@ -161,6 +374,7 @@ def main(
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     try:
         args = parse_args()
         setup_logging(args.debug)
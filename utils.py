@@ -1,4 +1,6 @@
 import os
+import re
+import stat
 import glob
 import argparse
 import subprocess
@@ -8,12 +10,20 @@ import pytz
 import orgparse.date
 import yaml
 
+from functools import lru_cache
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 _DEFAULT_TODO_KEYWORDS = [
     'PROGRESS', 'OPEN', 'NEXT', 'RUNNING', 'PAUSED',
     'TODO', 'WAITING', 'WAIT', 'DELEGATED', 'AGAIN',
     'DONE', 'CANCELLED', 'FUTURE', 'READY']
 _DEFAULT_PRIORITIES = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+_DEFAULT_TIMEZONE = 'Europe/Berlin'
+_TIMEZONE = pytz.timezone(_DEFAULT_TIMEZONE)
 
 
 def parse_args() -> argparse.Namespace:
@@ -41,8 +51,9 @@ def setup_logging(debug: bool = False) -> None:
         logging.basicConfig(level=logging.INFO, format=format, datefmt=datefmt)
 
 
+@lru_cache(maxsize=4096)
 def get_datetime_from_org(
-    org_timestamp: str, timezone: str = 'Europe/Berlin'
+    org_timestamp: str, timezone: str = _DEFAULT_TIMEZONE
 ) -> dt.datetime | dt.date | None:
     '''
     Get a datetime object from an org timestamp.
@@ -61,13 +72,33 @@ def get_datetime_from_org(
     dt_object = orgparse.date.OrgDate.from_str(org_timestamp).start
 
     if isinstance(dt_object, dt.datetime):
-        return pytz.timezone(timezone).localize(dt_object)
+        tzinfo = _TIMEZONE if timezone == _DEFAULT_TIMEZONE else pytz.timezone(timezone)
+        return tzinfo.localize(dt_object)
     elif isinstance(dt_object, dt.date):
         return dt_object
     else:
         return None
 
 
+@lru_cache(maxsize=None)
+def _get_heading_prefix_re(todo_keywords: tuple[str, ...], priorities: tuple[str, ...]) -> re.Pattern:
+    '''
+    Compile a pattern matching all todo keywords and priorities at the start of a heading.
+    Every keyword and priority is optional and matched in list order, followed by whitespace.
+
+    Args:
+        todo_keywords (tuple[str, ...]): The todo keywords to match.
+        priorities (tuple[str, ...]): The priorities to match.
+
+    Returns:
+        re.Pattern: The compiled pattern, it always matches.
+    '''
+
+    parts = [re.escape(keyword) for keyword in todo_keywords]
+    parts += [re.escape(f'[#{priority}]') for priority in priorities]
+    return re.compile(''.join(f'(?:{part}\\s*)?' for part in parts))
+
+
 def clean_up_heading(
     heading: str,
     todo_keywords: list[str] | None = None,
@@ -90,16 +121,8 @@ def clean_up_heading(
     todo_keywords = todo_keywords or _DEFAULT_TODO_KEYWORDS
     priorities = priorities or _DEFAULT_PRIORITIES
 
-    for keyword in todo_keywords:
-        if heading.startswith(keyword):
-            heading = heading[len(keyword):].lstrip()
-
-    for priority in priorities:
-        priority_str = f'[#{priority}]'
-        if heading.startswith(priority_str):
-            heading = heading[len(priority_str):].lstrip()
-
-    return heading.strip()
+    prefix_match = _get_heading_prefix_re(tuple(todo_keywords), tuple(priorities)).match(heading)
+    return heading[prefix_match.end():].strip()
 
 
 def load_all_headings_from_file(filename: str) -> list | None:
@@ -113,11 +136,13 @@ def load_all_headings_from_file(filename: str) -> list | None:
         list | None: A list of headings or None if the file could not be found or read.
     '''
 
-    if not os.path.exists(filename):
+    try:
+        file_stat = os.stat(filename)
+    except OSError:
         logging.error(f'The specified org file could not be found: {filename}')
         return None
 
-    if not os.path.isfile(filename):
+    if not stat.S_ISREG(file_stat.st_mode):
         logging.error(f'The specified path is not a file: {filename}')
         return None
 
@@ -135,36 +160,61 @@ def load_all_headings_from_file(filename: str) -> list | None:
     return nodes
 
 
-def get_all_org_file_in_directory(directory_path: str) -> list[str] | None:
+def is_valid_directory(directory_path: str) -> bool:
     '''
-    Get all org files in a directory and return a list of file paths.
+    Check that a path exists and is a directory, logging an error otherwise.
 
     Args:
-        directory_path (str): The path to the directory to search.
+        directory_path (str): The path to check.
 
     Returns:
-        list[str] | None: A list of file paths or None if the directory does not exist or is not a directory.
+        bool: True if the path is an existing directory.
     '''
 
     if not os.path.exists(directory_path):
         logging.error(f'The specified directory could not be found: {directory_path}')
-        return None
+        return False
 
     if not os.path.isdir(directory_path):
         logging.error(f'The specified path is not a directory: {directory_path}')
-        return None
+        return False
+
+    return True
+
+
+def get_all_org_files_in_directories(directory_paths: list[str]) -> list[list[str]]:
+    '''
+    Get all org files in several directories with a single `rg` run.
+
+    Args:
+        directory_paths (list[str]): The paths to the directories to search.
+
+    Returns:
+        list[list[str]]: A list of file paths for each directory, in the given order.
+    '''
+
+    files_lists: list[list[str]] = [[] for _ in directory_paths]
+
+    if not directory_paths:
+        return files_lists
 
     # get files that contain schedules/deadlines
     files_proc = subprocess.run(
-        ["rg", "-g", "*.org", "-li", r"(SCHEDULED|DEADLINE):", directory_path],
+        ["rg", "-g", "*.org", "-li", r"(SCHEDULED|DEADLINE):", *directory_paths],
         capture_output=True, text=True
     )
-    files_list = []
-    for line in files_proc.stdout.strip().split("\n"):
-        if ".sync-conflict-" not in line:
-            files_list.append(line.strip())
 
-    return sorted(files_list, reverse=True)
+    # assign every file to the first directory containing it
+    for line in files_proc.stdout.splitlines():
+        line = line.strip()
+        if not line or ".sync-conflict-" in line:
+            continue
+        for files_list, directory_path in zip(files_lists, directory_paths):
+            if not os.path.relpath(line, directory_path).startswith(os.pardir):
+                files_list.append(line)
+                break
+
+    return [sorted(files_list, reverse=True) for files_list in files_lists]
 
 
 def get_all_org_files_from_mixed_list(
@@ -172,6 +222,7 @@ def get_all_org_files_from_mixed_list(
 ) -> list[str]:
     '''
     Get all org files from a mixed list and return a list of file paths.
+    All directories are searched with a single `rg` run.
 
     Args:
         mixed_list (list[str]): The mixed list to search.
@@ -181,37 +232,35 @@ def get_all_org_files_from_mixed_list(
         list[str]: A list of file paths.
     '''
 
-    files: list[str] = []
+    # directories are kept as None placeholders to preserve the order
+    entries: list[str | None] = []
+    directory_paths: list[str] = []
 
     for name in mixed_list:
-        if os.path.isdir(name):
-            files += get_all_org_file_in_directory(os.path.join(base_path, name)) or []
-        elif os.path.isfile(name):
-            files.append(name)
-
-    return files
-
-
-def load_all_headings_from_mixed_list(
-    mixed_list: list[str]
-) -> list:
-    '''
-    Load all headings from org files and return a list of headings.
-
-    Args:
-        mixed_list (list[str]): The mixed list to search.
-
-    Returns:
-        list: A list of headings.
-    '''
-
-    files = get_all_org_files_from_mixed_list(mixed_list)
-    nodes = []
+        try:
+            mode = os.stat(name).st_mode
+        except OSError:
+            continue
+
+        if stat.S_ISDIR(mode):
+            # without a base path the directory was just checked
+            directory_path = os.path.join(base_path, name)
+            if not base_path or is_valid_directory(directory_path):
+                directory_paths.append(directory_path)
+                entries.append(None)
+        elif stat.S_ISREG(mode):
+            entries.append(name)
+
+    files_lists = iter(get_all_org_files_in_directories(directory_paths))
+    files: list[str] = []
 
-    for filename in files:
-        nodes += load_all_headings_from_file(filename) or []
+    for entry in entries:
+        if entry is None:
+            files += next(files_lists)
+        else:
+            files.append(entry)
 
-    return nodes
+    return files
 
 
 def read_config_file(filename: str) -> dict | None:
@@ -241,7 +290,7 @@ def read_config_file(filename: str) -> dict | None:
         return None
 
     with open(filename, 'r') as config_file:
-        return yaml.safe_load(config_file)
+        return yaml.load(config_file, Loader=SafeLoader)
 
 
 def force_timestamp(scheduled: dt.datetime | dt.date | None) -> dt.datetime:
@@ -259,6 +308,6 @@ def force_timestamp(scheduled: dt.datetime | dt.date | None) -> dt.datetime:
         return scheduled
     elif isinstance(scheduled, dt.date):
         date = dt.datetime(scheduled.year, scheduled.month, scheduled.day)
-        return pytz.timezone('Europe/Berlin').localize(date)
+        return _TIMEZONE.localize(date)
     else:
-        return dt.datetime.now()
+        return dt.datetime.now(_TIMEZONE)